@@ -1,7 +1,7 @@
 import argparse, json, sys, pathlib, requests
 
-def post(url, data=None, json_=None, files=None):
-    r = requests.post(url, data=data, json=json_, files=files, timeout=120)
+def post(url, data=None, json_=None, files=None, headers=None):
+    r = requests.post(url, data=data, json=json_, files=files, headers=headers, timeout=120)
     r.raise_for_status()
     return r.json()
 
@@ -10,9 +10,21 @@ def get(url):
     r.raise_for_status()
     return r.json()
 
+def iter_file(path, size=1 << 20):
+    # bloques de 1 MiB: requests los manda con chunked transfer-encoding, sin cargar el archivo
+    with open(path, "rb") as f:
+        for b in iter(lambda: f.read(size), b""):
+            yield b
+
+def show(obj, compact=False):
+    # json.dump escribe por partes en stdout: no arma el string completo en memoria
+    json.dump(obj, sys.stdout, indent=None if compact else 2, ensure_ascii=False)
+    sys.stdout.write("\n")
+
 def main():
     ap = argparse.ArgumentParser("GridMR client")
     ap.add_argument("--master", required=True, help="URL del master, p.ej http://localhost:8000")
+    ap.add_argument("--compact", action="store_true", help="JSON en una línea, sin indentar (resultados grandes / pipes)")
     sub = ap.add_subparsers(dest="cmd", required=True)
 
     s1 = sub.add_parser("submit-text")
@@ -33,19 +45,19 @@ def main():
 
     if args.cmd == "submit-text":
         payload = {"input_text": args.text, "split_size": args.split, "num_reducers": args.reducers}
-        print(json.dumps(post(f"{args.master}/submit", json_=payload), indent=2, ensure_ascii=False))
+        show(post(f"{args.master}/submit", json_=payload), args.compact)
 
     elif args.cmd == "submit-file":
         p = pathlib.Path(args.path)
         if not p.exists(): sys.exit(f"No existe: {p}")
         print("[1/2] Subiendo archivo…")
-        res = post(f"{args.master}/upload_job_input", data={"job_id": args.job}, files={"file": (p.name, p.open("rb"), "text/plain")})
+        post(f"{args.master}/upload_job_input", data=iter_file(p), headers={"content-type": "application/octet-stream", "X-Job-Id": args.job})
         print("[2/2] Lanzando job…")
         payload = {"job_id": args.job, "split_size": args.split, "num_reducers": args.reducers}
-        print(json.dumps(post(f"{args.master}/submit_file", json_=payload), indent=2, ensure_ascii=False))
+        show(post(f"{args.master}/submit_file", json_=payload), args.compact)
 
     elif args.cmd == "status":
-        print(json.dumps(get(f"{args.master}/status/{args.job_id}"), indent=2, ensure_ascii=False))
+        show(get(f"{args.master}/status/{args.job_id}"), args.compact)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,12 +1,17 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Form, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import Dict, Optional, List, Tuple
-from collections import Counter
-import re, uuid, time, asyncio, os, shutil, json, sqlite3
+from typing import Dict, Iterable, Optional, List, Tuple
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import re, uuid, time, asyncio, os, shutil, json, sqlite3, gzip, itertools, random, threading, mmap, logging
 import httpx
+import msgpack
 from pathlib import Path
 
 app = FastAPI(title="GridMR Master", version="0.5")
+log = logging.getLogger("uvicorn.error")  # mismo logger (y salida) que uvicorn
 
 # ---------------- Config ----------------
 DATA_DIR = Path(os.getenv("MASTER_DATA_DIR", "/data/master"))
@@ -22,6 +27,13 @@ STATIC_WORKERS: List[str] = [
 DEFAULT_NUM_REDUCERS = int(os.getenv("DEFAULT_NUM_REDUCERS", "2"))
 HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", "5"))   # seg (monitor)
 HEARTBEAT_TTL = int(os.getenv("HEARTBEAT_TTL", "15"))            # seg (timeout)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "64"))  # pool hacia los workers
+MAP_BATCH_MAX = int(os.getenv("MAP_BATCH_MAX", "32"))                # splits por request de map (lote)
+MAP_BATCH_BYTES = int(os.getenv("MAP_BATCH_BYTES", str(16 << 20)))   # tope de bytes por lote de /submit_file
+JOBS_CACHE_MAX = int(os.getenv("JOBS_CACHE_MAX", "128"))             # jobs terminados en memoria (LRU)
+DB_BATCH_MAX = 256                                                   # jobs por transacción del writer de SQLite
+LOAD_DECAY_S = float(os.getenv("LOAD_DECAY_S", "60"))                # in_flight sin envíos nuevos se drena a 0 en este lapso
+MAX_RETRIES = 2                                                      # intentos por lote de map (cada uno en otro worker)
 
 # ---------------- Modelos ----------------
 class WorkerInfo(BaseModel):
@@ -33,17 +45,20 @@ class WorkerInfo(BaseModel):
     last_error: Optional[str] = None
     last_seen: Optional[float] = None  # timestamp último heartbeat
     remote_in_flight: Optional[int] = None
+    last_dispatch: float = 0.0         # time.monotonic() del último request enviado
 
 class SubmitReq(BaseModel):
     input_text: str
     split_size: int = 5000
     num_reducers: int = DEFAULT_NUM_REDUCERS
     job_id: Optional[str] = None
+    case_sensitive: bool = False   # True: no pasa a minúsculas (ahorra el lower() en textos sin mayúsculas, p.ej. CJK)
 
 class SubmitFileReq(BaseModel):
     job_id: str
     split_size: int = 1024
     num_reducers: int = DEFAULT_NUM_REDUCERS
+    case_sensitive: bool = False
 
 class JobStatus(BaseModel):
     job_id: str
@@ -53,20 +68,50 @@ class JobStatus(BaseModel):
     elapsed_ms: Optional[int] = None
     map_attempts: Optional[int] = 0
     reducers: Optional[List[str]] = None
+    total_splits: Optional[int] = None
+    done_splits: Optional[int] = None
+
+# Los JobStatus los arma el master con datos propios: se crean con model_construct (sin validar
+# el dict de resultados palabra por palabra) y se responden serializados directo por pydantic-core.
+# response_model queda en los endpoints solo para la documentación OpenAPI.
+def job_response(st: JobStatus) -> Response:
+    return Response(st.model_dump_json(), media_type="application/json")
 
 # ---------------- Estado ----------------
 WORKERS: Dict[str, WorkerInfo] = {u: WorkerInfo(url=u) for u in STATIC_WORKERS}
-JOBS: Dict[str, JobStatus] = {}
+JOBS: "OrderedDict[str, JobStatus]" = OrderedDict()  # LRU: los jobs terminados más viejos se sacan (quedan en SQLite)
+PROGRESS: Dict[str, int] = {}  # splits terminados por job en curso: un int, no un JobStatus nuevo por map
+UNSAVED: Dict[str, int] = {}  # estados encolados y aún sin COMMIT por job: esos jobs no salen de JOBS
+
+def remember_job(st: JobStatus):
+    JOBS[st.job_id] = st
+    JOBS.move_to_end(st.job_id)
+    if len(JOBS) > JOBS_CACHE_MAX:
+        # solo se descartan jobs terminados y ya escritos: su resultado sigue en SQLite y /status lo
+        # recarga (el recién recordado tampoco: se llama antes de su persist)
+        for jid in [j for j, s in JOBS.items() if s.status in ("done", "error") and j not in UNSAVED and j != st.job_id]:
+            if len(JOBS) <= JOBS_CACHE_MAX:
+                break
+            del JOBS[jid]
 
 # ---------------- Persistencia (SQLite) ----------------
-def _db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    return conn
+_DB: Optional[sqlite3.Connection] = None
+_DB_LOCK = threading.Lock()  # la conexión se comparte entre el hilo de escritura y los de /status
+_DB_EXEC = ThreadPoolExecutor(max_workers=1)  # escrituras en orden y fuera del event loop
+
+def _db() -> sqlite3.Connection:
+    # una conexión para todo el proceso (antes: connect + PRAGMA en cada save/load);
+    # autocommit, y NORMAL en WAL solo sincroniza en los checkpoints (sigue sin corromperse)
+    global _DB
+    if _DB is None:
+        _DB = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        _DB.execute("PRAGMA journal_mode=WAL;")
+        _DB.execute("PRAGMA synchronous=NORMAL;")
+    return _DB
 
 def init_db():
-    with _db() as conn:
-        conn.execute("""
+    with _DB_LOCK:
+        _db().execute("""
         CREATE TABLE IF NOT EXISTS jobs (
           job_id TEXT PRIMARY KEY,
           status TEXT NOT NULL,
@@ -78,93 +123,208 @@ def init_db():
           updated_at REAL NOT NULL
         );
         """)
-        conn.commit()
-
-def save_job(st: JobStatus):
-    with _db() as conn:
-        conn.execute("""
-        INSERT INTO jobs(job_id,status,result_json,message,elapsed_ms,map_attempts,reducers_json,updated_at)
-        VALUES(?,?,?,?,?,?,?,?)
-        ON CONFLICT(job_id) DO UPDATE SET
-          status=excluded.status,
-          result_json=excluded.result_json,
-          message=excluded.message,
-          elapsed_ms=excluded.elapsed_ms,
-          map_attempts=excluded.map_attempts,
-          reducers_json=excluded.reducers_json,
-          updated_at=excluded.updated_at;
-        """, (
-            st.job_id,
-            st.status,
-            json.dumps(st.result) if st.result is not None else None,
-            st.message,
-            st.elapsed_ms,
-            st.map_attempts,
-            json.dumps(st.reducers) if st.reducers is not None else None,
-            time.time()
-        ))
-        conn.commit()
+
+# SQL fijo a nivel de módulo: sqlite3 cachea el statement preparado por texto y no lo re-parsea
+_SAVE_SQL = """
+INSERT INTO jobs(job_id,status,result_json,message,elapsed_ms,map_attempts,reducers_json,updated_at)
+VALUES(?,?,?,?,?,?,?,?)
+ON CONFLICT(job_id) DO UPDATE SET
+  status=excluded.status,
+  result_json=excluded.result_json,
+  message=excluded.message,
+  elapsed_ms=excluded.elapsed_ms,
+  map_attempts=excluded.map_attempts,
+  reducers_json=excluded.reducers_json,
+  updated_at=excluded.updated_at;
+"""
+_LOAD_SQL = "SELECT job_id,status,result_json,message,elapsed_ms,map_attempts,reducers_json FROM jobs WHERE job_id=?;"
+
+def _job_row(st: JobStatus) -> tuple:
+    return (
+        st.job_id,
+        st.status,
+        json.dumps(st.result) if st.result is not None else None,
+        st.message,
+        st.elapsed_ms,
+        st.map_attempts,
+        json.dumps(st.reducers) if st.reducers is not None else None,
+        time.time()
+    )
+
+def save_jobs(batch: List[JobStatus]):
+    rows = [_job_row(st) for st in batch]
+    with _DB_LOCK:
+        conn = _db()
+        conn.execute("BEGIN IMMEDIATE;")  # una transacción (un commit) para todo el lote
+        try:
+            conn.executemany(_SAVE_SQL, rows)
+        except Exception:
+            conn.execute("ROLLBACK;"); raise
+        conn.execute("COMMIT;")
+
+_WRITE_Q: "asyncio.Queue[JobStatus]" = asyncio.Queue()
+
+def persist(st: JobStatus):
+    # no espera al disco: el writer junta lo encolado y lo escribe en su hilo
+    UNSAVED[st.job_id] = UNSAVED.get(st.job_id, 0) + 1
+    _WRITE_Q.put_nowait(st)
+
+def mark_saved(pending: Dict[str, int]):
+    for jid, n in pending.items():
+        left = UNSAVED.get(jid, 0) - n
+        if left > 0:
+            UNSAVED[jid] = left
+        else:
+            UNSAVED.pop(jid, None)
+
+async def db_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        st = await _WRITE_Q.get()
+        # mientras se escribe un lote se acumula el siguiente; de un mismo job basta el último estado
+        batch = {st.job_id: st}
+        pending = Counter([st.job_id])  # encolados por job en este lote (para descontar de UNSAVED)
+        while not _WRITE_Q.empty() and len(batch) < DB_BATCH_MAX:
+            st = _WRITE_Q.get_nowait(); batch[st.job_id] = st; pending[st.job_id] += 1
+        # un lote fallido no mata al writer: se reintenta con backoff; mientras tanto sus jobs
+        # siguen en UNSAVED y remember_job no los saca de JOBS
+        delay = 0.5
+        while True:
+            try:
+                await loop.run_in_executor(_DB_EXEC, save_jobs, list(batch.values()))
+                break
+            except Exception:
+                log.exception("no se pudo guardar un lote de %d jobs; reintento en %.1fs", len(batch), delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+        mark_saved(pending)
 
 def load_job(job_id: str) -> Optional[JobStatus]:
-    with _db() as conn:
-        cur = conn.execute("SELECT job_id,status,result_json,message,elapsed_ms,map_attempts,reducers_json FROM jobs WHERE job_id=?;", (job_id,))
-        row = cur.fetchone()
+    with _DB_LOCK:
+        row = _db().execute(_LOAD_SQL, (job_id,)).fetchone()
     if not row:
         return None
     result = json.loads(row[2]) if row[2] else None
     reducers = json.loads(row[6]) if row[6] else None
-    return JobStatus(job_id=row[0], status=row[1], result=result, message=row[3], elapsed_ms=row[4], map_attempts=row[5], reducers=reducers)
+    return JobStatus.model_construct(job_id=row[0], status=row[1], result=result, message=row[3], elapsed_ms=row[4], map_attempts=row[5], reducers=reducers)
 
 # ---------------- Utilidades MR ----------------
-_word_re = re.compile(r"[\wáéíóúñüÁÉÍÓÚÑÜ']+", re.UNICODE)
-
-def local_reduce(partials: List[Dict[str, int]]) -> Dict[str, int]:
-    total = Counter()
-    for p in partials:
-        total.update(p)
-    return dict(total)
+_word_re = re.compile(r"[\w']+")  # \w ya es Unicode (incluye áéíóúñü)
+_ASCII_WORD = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_'")
+# ASCII: no-palabra -> espacio (y mayúsculas -> minúsculas en _lower); translate + split() en C
+_ascii_tt = str.maketrans({chr(c): chr(c) if chr(c) in _ASCII_WORD else " " for c in range(128)})
+_ascii_lower_tt = str.maketrans({chr(c): chr(c).lower() if chr(c) in _ASCII_WORD else " " for c in range(128)})
+
+# ---------------- Map local (sin workers) ----------------
+# mismo tokenizado que worker/main.py; funciones top-level para poder enviarlas al pool
+def tokenize(text: str, lower: bool = True) -> List[str]:
+    if not lower:  # job case_sensitive: ni una pasada de lower()
+        return text.translate(_ascii_tt).split() if text.isascii() else _word_re.findall(text)
+    if text.isascii():  # O(1) en CPython: es un flag del str
+        return text.translate(_ascii_lower_tt).split()
+    if "İ" in text or "Σ" in text:  # "İ".lower() agrega U+0307 (no es \w) y ς depende del contexto: por token
+        return [w.lower() for w in _word_re.findall(text)]
+    return _word_re.findall(text.lower())
+
+# Counter(iterable) cuenta en C (_count_elements), más rápido que un bucle con dict.get;
+# se devuelve tal cual (es un dict) para no pagar una copia extra
+def local_map(text: str, lower: bool = True) -> Dict[str, int]:
+    return Counter(tokenize(text, lower))
+
+def local_map_range(fp: Path, rng: Tuple[int, int], lower: bool = True) -> Dict[str, int]:
+    with fp.open("rb") as f:
+        f.seek(rng[0])
+        data = f.read(rng[1] - rng[0])
+    return local_map(data.decode("utf-8", errors="ignore"), lower)
+
+_POOL: Optional[ProcessPoolExecutor] = None  # se crea al primer job local
+
+async def local_map_reduce(fn, items: list) -> Dict[str, int]:
+    # el map es CPU puro: se reparte en un proceso por core (pocos splits -> directo, sin el
+    # costo del pool, pero en un hilo: en submit_file un split puede ser un rango de cientos de MB);
+    # cada parcial se suma al total apenas llega, sin guardar la lista completa
+    global _POOL
+    if len(items) < 4:
+        return await asyncio.to_thread(local_reduce, map(fn, items))
+    cpu = os.cpu_count() or 1
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(max_workers=cpu)
+    chunksize = max(1, len(items) // (4 * cpu))
+    return await asyncio.to_thread(lambda: local_reduce(_POOL.map(fn, items, chunksize=chunksize)))
+
+def any_healthy() -> bool:
+    return any(w.healthy for w in WORKERS.values())
+
+def local_reduce(partials: Iterable[Dict[str, int]]) -> Dict[str, int]:
+    # merge directo sobre el dict destino: sin Counter intermedio ni copia final;
+    # el destino arranca como copia del primer parcial (dict(p) en C), que así no se recorre
+    it = iter(partials)
+    total: Dict[str, int] = dict(next(it, {}))
+    get = total.get
+    for p in it:
+        for k, v in p.items():
+            total[k] = get(k, 0) + v
+    return total
 
 def split_text(s: str, chunk_size: int) -> List[str]:
+    # una sola pasada: cada slice se corta en un espacio y nunca queda vacío,
+    # así que no hace falta filtrar la lista al final; avanza chunk_size caracteres con rfind (en C)
+    if chunk_size <= 0:
+        chunk_size = 5000
     chunks = []
-    i = 0
-    while i < len(s):
-        end = min(i + chunk_size, len(s))
-        if end < len(s):
+    i, n = 0, len(s)
+    while i < n:
+        end = min(i + chunk_size, n)
+        if end < n:
             j = s.rfind(" ", i, end)
-            if j != -1 and j > i:
+            if j > i:
                 end = j
         chunks.append(s[i:end])
         i = end
-        if i < len(s) and s[i] == " ":
+        if i < n and s[i] == " ":
             i += 1
-    return [c for c in chunks if c]
-
-def split_file_text(fp: Path, approx_bytes: int) -> List[Tuple[int, Path]]:
-    out_dir = fp.parent / "splits"
-    out_dir.mkdir(parents=True, exist_ok=True)
-    splits: List[Tuple[int, Path]] = []
-    with fp.open("r", encoding="utf-8", errors="ignore") as f:
-        buf, size, sid = [], 0, 0
-        for line in f:
-            lb = line.encode("utf-8")
-            if size + len(lb) > approx_bytes and buf:
-                p = out_dir / f"chunk_{sid}.txt"
-                p.write_text("".join(buf), encoding="utf-8")
-                splits.append((sid, p))
-                buf, size, sid = [], 0, sid + 1
-            buf.append(line); size += len(lb)
-        if buf:
-            p = out_dir / f"chunk_{sid}.txt"
-            p.write_text("".join(buf), encoding="utf-8")
-            splits.append((sid, p))
-    return splits
-
-def partition_by_key(partials: List[Dict[str,int]], R: int) -> List[Dict[str,int]]:
-    shards = [Counter() for _ in range(max(1, R))]
-    for p in partials:
-        for k, v in p.items():
-            shards[hash(k) % len(shards)][k] += v
-    return [dict(c) for c in shards]
+    return chunks
+
+def split_file_ranges(mm: mmap.mmap, approx_bytes: int) -> List[Tuple[int, int]]:
+    # búsqueda de bordes en bytes sobre el mmap: sin decodificar, sin un str por línea y sin
+    # escribir splits a disco; cada split es un rango [i, j) del archivo
+    approx_bytes = max(1, approx_bytes)
+    size = len(mm)
+    ranges: List[Tuple[int, int]] = []
+    i = 0
+    while i < size:
+        end = i + approx_bytes
+        if end >= size:
+            j = size
+        else:
+            # se corta tras el último salto de línea (o espacio) del bloque: ambos son
+            # ASCII, así que nunca se parte una palabra ni una secuencia UTF-8
+            j = mm.rfind(b"\n", i, end) + 1 or mm.rfind(b" ", i, end) + 1
+            if not j:  # una sola palabra más larga que el bloque: hasta el próximo separador
+                seps = [x for x in (mm.find(b"\n", end), mm.find(b" ", end)) if x >= 0]
+                j = min(seps) + 1 if seps else size
+        ranges.append((i, j))
+        i = j
+    return ranges
+
+def merge_shards(partitions: List[Dict[str,int]], shards: list) -> None:
+    # shuffle incremental: el worker ya particionó su salida (crc32, estable entre procesos),
+    # así que cada shard se suma a su partición sin volver a hashear palabra por palabra;
+    # los shards llegan como columnas (palabras, conteos) y se recorren con zip.
+    # El primero que llega a una partición vacía entra entero con update (en C)
+    for d, (ks, vs) in zip(partitions, shards):
+        if not d:
+            d.update(zip(ks, vs)); continue
+        get = d.get
+        for k, v in zip(ks, vs):
+            d[k] = get(k, 0) + v
+
+_rr = itertools.count()  # turno round robin global (avanza entre jobs, no solo dentro de uno)
+
+def effective_load(w: WorkerInfo, now: float) -> float:
+    # in_flight decae linealmente desde el último envío: un request colgado (o un worker que se
+    # cayó y volvió) no deja al worker "ocupado" para siempre ante el scheduler
+    return w.in_flight * max(0.0, 1 - (now - w.last_dispatch) / LOAD_DECAY_S)
 
 def choose_worker() -> WorkerInfo:
     healthy = [w for w in WORKERS.values() if w.healthy]
@@ -172,10 +332,21 @@ def choose_worker() -> WorkerInfo:
         healthy = list(WORKERS.values())
         if not healthy:
             raise HTTPException(503, "No hay workers registrados")
-    return min(healthy, key=lambda w: (w.in_flight / max(1, w.capacity), w.in_flight))
+    now = time.monotonic()
+    load = lambda w: (effective_load(w, now) / max(1, w.capacity), effective_load(w, now))
+    if len(healthy) > 2:
+        # power of two choices: O(1) por decisión y sin que todas las tareas de una ráfaga
+        # caigan sobre el mismo "menos cargado"
+        a, b = random.sample(healthy, 2)
+        return a if load(a) <= load(b) else b
+    # la lista arranca en el worker del turno: a igual carga gana el del turno, no siempre el primero
+    start = next(_rr) % len(healthy)
+    ordered = healthy[start:] + healthy[:start]
+    return min(ordered, key=load)
 
 def choose_n_workers(n: int) -> List[WorkerInfo]:
-    ws = sorted(WORKERS.values(), key=lambda w: (0 if w.healthy else 1, w.in_flight / max(1, w.capacity), w.in_flight))
+    now = time.monotonic()
+    ws = sorted(WORKERS.values(), key=lambda w: (0 if w.healthy else 1, effective_load(w, now) / max(1, w.capacity), effective_load(w, now)))
     picked, seen = [], set()
     for w in ws:
         if w.url not in seen:
@@ -188,48 +359,138 @@ def choose_n_workers(n: int) -> List[WorkerInfo]:
         picked.append(picked[0])
     return picked
 
-async def worker_upload(client: httpx.AsyncClient, worker: WorkerInfo, job_id: str, split_id: int, file_path: Path) -> str:
-    files = {"file": (file_path.name, file_path.open("rb"), "text/plain")}
-    data = {"job_id": job_id, "split_id": str(split_id)}
-    r = await client.post(f"{worker.url}/upload", data=data, files=files, timeout=120)
-    r.raise_for_status()
-    return r.json()["file_path"]
+# tráfico interno master <-> worker en msgpack (JSON queda para la API pública; Arrow: Informe.md §6)
+MSGPACK = "application/msgpack"
+
+GZIP_MIN_BYTES = 1024  # bajo esto comprimir no compensa
+
+def encode_msgpack(payload: dict) -> Tuple[bytes, Dict[str,str]]:
+    body = msgpack.packb(payload)
+    headers = {"content-type": MSGPACK, "accept": MSGPACK}
+    if len(body) >= GZIP_MIN_BYTES:
+        # texto y conteos comprimen 3-5x; nivel 1 = casi sin costo de CPU
+        body = gzip.compress(body, compresslevel=1)
+        headers["content-encoding"] = "gzip"
+    return body, headers
+
+def decode_msgpack(raw: bytes, encoding: Optional[str]) -> dict:
+    if encoding == "gzip":
+        raw = gzip.decompress(raw)
+    return msgpack.unpackb(raw, raw=False)
+
+async def post_msgpack(client: httpx.AsyncClient, url: str, body: bytes, headers: Dict[str,str], timeout: float) -> dict:
+    # recibe el cuerpo ya codificado: los reintentos reenvían los mismos bytes. La respuesta
+    # (con gzip del worker) se lee cruda y se descomprime + desempaqueta en un hilo, como
+    # merge_shards: con cientos de miles de palabras no frena heartbeats ni /status
+    async with client.stream("POST", url, content=body, headers=headers, timeout=timeout) as r:
+        r.raise_for_status()
+        raw = b"".join([part async for part in r.aiter_raw()])
+        encoding = r.headers.get("content-encoding")
+    return await asyncio.to_thread(decode_msgpack, raw, encoding)
 
-async def worker_map(client: httpx.AsyncClient, worker: WorkerInfo, payload: dict) -> Dict[str,int]:
+async def worker_call(client: httpx.AsyncClient, worker: WorkerInfo, path: str, body: bytes, headers: Dict[str,str], timeout: float = 120) -> dict:
     try:
         worker.in_flight += 1
-        r = await client.post(f"{worker.url}/map", json=payload, timeout=120)
-        r.raise_for_status()
-        data = r.json()
+        worker.last_dispatch = time.monotonic()
+        data = await post_msgpack(client, f"{worker.url}{path}", body, headers, timeout)
         worker.last_error = None
         worker.healthy = True
-        return data["counts"]
+        return data
     except Exception as e:
         worker.last_error = str(e); worker.healthy = False
         raise
     finally:
         worker.in_flight = max(0, worker.in_flight - 1)
 
+def map_shards(data: dict) -> list:
+    # con num_reducers > 1 el worker responde "shards" en columnas; con 1, "counts" es el único shard
+    if "shards" in data:
+        return data["shards"]
+    c = data["counts"]
+    return [(c.keys(), c.values())]
+
+def healthy_slots() -> int:
+    return sum(w.capacity for w in WORKERS.values() if w.healthy) or 1
+
+def map_batch_size(n_chunks: int) -> int:
+    # ~2 lotes por slot de capacidad sana, para que el balanceo siga teniendo margen
+    return max(1, min(MAP_BATCH_MAX, -(-n_chunks // (2 * healthy_slots()))))
+
+def batch_ranges(splits: List[Tuple[int, int]], bs: int) -> List[List[Tuple[int, int]]]:
+    # hasta bs splits por lote y, con splits grandes, no más de MAP_BATCH_BYTES (mínimo uno)
+    batches: List[List[Tuple[int, int]]] = []
+    cur: List[Tuple[int, int]] = []
+    size = 0
+    for rng in splits:
+        n = rng[1] - rng[0]
+        if cur and (len(cur) >= bs or size + n > MAP_BATCH_BYTES):
+            batches.append(cur); cur = []; size = 0
+        cur.append(rng); size += n
+    if cur:
+        batches.append(cur)
+    return batches
+
+async def guarded(sem: asyncio.Semaphore, coro):
+    # la tarea existe, pero el request sale recién con un cupo libre: miles de splits no
+    # abren miles de conexiones y choose_worker elige con in_flight ya actualizado
+    try:
+        async with sem:
+            return await coro
+    finally:
+        coro.close()  # cancelada antes de tener cupo: sin el aviso "never awaited"
+
+async def map_with_retry(client: httpx.AsyncClient, path: str, payload: dict) -> dict:
+    # msgpack + gzip del payload una sola vez; cada reintento va a otro worker con los mismos bytes
+    body, headers = await asyncio.to_thread(encode_msgpack, payload)
+    for attempt in range(MAX_RETRIES):
+        worker = choose_worker()  # el que falló quedó healthy=False y ya no se elige
+        try:
+            return await worker_call(client, worker, path, body, headers)
+        except Exception:
+            if attempt == MAX_RETRIES - 1: raise
+
+async def map_file_split(client: httpx.AsyncClient, mm: mmap.mmap, ranges: List[Tuple[int, int]], payload: dict) -> dict:
+    # los bytes de cada split se copian del mmap recién aquí (ya con cupo en guarded): el input
+    # nunca está entero en memoria; viajan como bin de msgpack (uno por split) y el worker los
+    # cuenta de a uno, así su memoria la sigue acotando el split_size
+    return await map_with_retry(client, "/map", {**payload, "data": [mm[a:b] for a, b in ranges]})
+
 async def worker_reduce(client: httpx.AsyncClient, worker: WorkerInfo, job_id: str, shard_partials: List[Dict[str,int]]) -> Dict[str,int]:
+    payload = {"job_id": job_id, "partials": shard_partials}
+    body, headers = await asyncio.to_thread(encode_msgpack, payload)  # pack + gzip de la partición fuera del loop
+    return (await worker_call(client, worker, "/reduce", body, headers, timeout=180))["counts"]
+
+async def probe_worker(client: httpx.AsyncClient, worker: WorkerInfo):
     try:
-        worker.in_flight += 1
-        payload = {"job_id": job_id, "partials": shard_partials}
-        r = await client.post(f"{worker.url}/reduce", json=payload, timeout=180)
+        r = await client.get(f"{worker.url}/", timeout=2)
         r.raise_for_status()
-        data = r.json()
-        worker.last_error = None
-        worker.healthy = True
-        return data["counts"]
+        worker.healthy = True; worker.last_error = None
     except Exception as e:
-        worker.last_error = str(e); worker.healthy = False
-        raise
-    finally:
-        worker.in_flight = max(0, worker.in_flight - 1)
+        worker.healthy = False; worker.last_error = str(e)
+
+def track(task: asyncio.Task, job_id: str, n: int) -> asyncio.Task:
+    # al terminar bien, suma n splits al progreso del job
+    def bump(t: asyncio.Task):
+        if job_id in PROGRESS and not t.cancelled() and t.exception() is None:
+            PROGRESS[job_id] += n
+    task.add_done_callback(bump)
+    return task
+
+async def cancel_pending(tasks: List[asyncio.Task]):
+    # si un map falla del todo, los demás no siguen ocupando el semáforo ni posteando a los
+    # workers para un job que ya es error; gather recoge sus excepciones (sin "never retrieved")
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 # ---------------- Endpoints ----------------
 @app.on_event("startup")
 async def _startup():
     init_db()
+    # un solo cliente para todos los jobs: las conexiones keep-alive a los workers se reutilizan
+    # (keepalive_expiry 25 < --timeout-keep-alive 30 del worker: la conexión sobrevive entre jobs
+    # y el cliente la suelta antes de que el worker la cierre)
+    app.state.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS, keepalive_expiry=25))
     # monitor de health (marca unhealthy si se pierde el heartbeat)
     async def monitor():
         while True:
@@ -237,8 +498,29 @@ async def _startup():
             for w in WORKERS.values():
                 if w.last_seen and (now - w.last_seen > HEARTBEAT_TTL):
                     w.healthy = False
+            # los que nunca mandaron heartbeat (WORKERx_URL estáticos) se sondean aquí, en segundo
+            # plano: el estado queda cacheado por HEARTBEAT_INTERVAL y /submit no paga un pre-flight
+            silent = [w for w in WORKERS.values() if not w.last_seen]
+            if silent:
+                await asyncio.gather(*(probe_worker(app.state.client, w) for w in silent))
             await asyncio.sleep(HEARTBEAT_INTERVAL)
     asyncio.create_task(monitor())
+    app.state.db_writer = asyncio.create_task(db_writer())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await app.state.client.aclose()
+    app.state.db_writer.cancel()
+    rest = []
+    while not _WRITE_Q.empty():
+        rest.append(_WRITE_Q.get_nowait())
+    if rest:
+        _DB_EXEC.submit(save_jobs, rest)
+    _DB_EXEC.shutdown(wait=True)  # deja terminar las escrituras pendientes
+    if _DB is not None:
+        _DB.close()
+    if _POOL is not None:
+        _POOL.shutdown(cancel_futures=True)
 
 @app.get("/")
 def root():
@@ -270,58 +552,102 @@ def list_workers():
     return list(WORKERS.values())
 
 @app.post("/upload_job_input")
-def upload_job_input(job_id: str = Form(...), file: UploadFile = File(...)):
+async def upload_job_input(request: Request):
+    # multipart (job_id + file) o el cuerpo crudo en streaming (?job_id=... o header X-Job-Id):
+    # en ambos casos se copia a disco por bloques, nunca el archivo entero en memoria
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        job_id, file = form.get("job_id"), form.get("file")
+        if not job_id or file is None or isinstance(file, str):
+            raise HTTPException(422, "Se esperan los campos job_id y file")
+    else:
+        job_id, file = request.query_params.get("job_id") or request.headers.get("x-job-id"), None
+        if not job_id:
+            raise HTTPException(422, "Falta job_id (query ?job_id= o header X-Job-Id)")
     job_dir = DATA_DIR / "jobs" / job_id
-    job_dir.mkdir(parents=True, exist_ok=True)
+    await run_in_threadpool(job_dir.mkdir, parents=True, exist_ok=True)
     dst = job_dir / "input.txt"
-    with dst.open("wb") as out:
-        shutil.copyfileobj(file.file, out)
+    # se escribe a un temporal y recién al terminar reemplaza a input.txt: un upload cortado
+    # no deja truncado el input anterior. Todo el I/O de disco va al threadpool (no frena el loop)
+    tmp = job_dir / f"input.txt.{uuid.uuid4().hex}.part"
+    out = await run_in_threadpool(tmp.open, "wb")
+    try:
+        try:
+            if file is not None:
+                await run_in_threadpool(shutil.copyfileobj, file.file, out)
+            else:
+                async for block in request.stream():
+                    await run_in_threadpool(out.write, block)
+        finally:
+            await run_in_threadpool(out.close)
+        await run_in_threadpool(os.replace, tmp, dst)
+    except BaseException:
+        await run_in_threadpool(tmp.unlink, missing_ok=True)
+        raise
     return {"job_id": job_id, "stored_at": str(dst)}
 
 @app.post("/submit", response_model=JobStatus)
 async def submit(req: SubmitReq):
     job_id = req.job_id or str(uuid.uuid4())
-    st = JobStatus(job_id=job_id, status="running")
-    JOBS[job_id] = st; save_job(st)
+    st = JobStatus.model_construct(job_id=job_id, status="running")
+    remember_job(st); persist(st)
     start = time.perf_counter()
     attempts = 0
     try:
         chunks = split_text(req.input_text, req.split_size)
         if not chunks:
-            st = JobStatus(job_id=job_id, status="done", result={}, elapsed_ms=0, reducers=[])
-            JOBS[job_id] = st; save_job(st); return st
-
-        async with httpx.AsyncClient() as client:
-            # MAP
-            map_tasks = []
-            for i, chunk in enumerate(chunks):
-                attempts += 1
-                for attempt in range(2):
-                    worker = choose_worker()
-                    try:
-                        payload = {"job_id": job_id, "split_id": i, "chunk": chunk}
-                        map_tasks.append(worker_map(client, worker, payload)); break
-                    except Exception:
-                        if attempt == 1: raise
-            map_partials = await asyncio.gather(*map_tasks)
-
-            # SHUFFLE/PARTITION
-            R = max(1, req.num_reducers)
-            partitions = partition_by_key(map_partials, R)
-
-            # REDUCE (distribuido)
-            reducers = choose_n_workers(R)
-            red_tasks = [worker_reduce(client, reducers[i], job_id, [partitions[i]]) for i in range(R)]
-            reduced_shards = await asyncio.gather(*red_tasks)
-
-        final_counts = local_reduce(reduced_shards)
+            st = JobStatus.model_construct(job_id=job_id, status="done", result={}, elapsed_ms=0, reducers=[])
+            remember_job(st); persist(st); return job_response(st)
+
+        st.total_splits = len(chunks); PROGRESS[job_id] = 0
+        if not any_healthy():
+            # fallback: sin workers sanos, map + reduce en el master
+            attempts = len(chunks)
+            final_counts = await local_map_reduce(partial(local_map, lower=not req.case_sensitive), chunks)
+            elapsed_ms = int((time.perf_counter() - start) * 1000)
+            st = JobStatus.model_construct(job_id=job_id, status="done", result=final_counts, elapsed_ms=elapsed_ms, map_attempts=attempts, reducers=[], total_splits=len(chunks), done_splits=len(chunks))
+            remember_job(st); persist(st); return job_response(st)
+
+        client: httpx.AsyncClient = app.state.client
+        # MAP (en lotes: un POST /map_batch por grupo de splits)
+        bs = map_batch_size(len(chunks))
+        R = max(1, req.num_reducers)
+        sem = asyncio.Semaphore(2 * healthy_slots())  # tope de requests en vuelo de este job
+        map_tasks = []
+        for b in range(0, len(chunks), bs):
+            batch = chunks[b:b + bs]
+            attempts += len(batch)
+            payload = {"job_id": job_id, "chunks": batch, "case_sensitive": req.case_sensitive, "num_reducers": R}
+            map_tasks.append(track(asyncio.create_task(guarded(sem, map_with_retry(client, "/map_batch", payload))), job_id, len(batch)))
+
+        # SHUFFLE a medida que terminan los map: los workers ya devuelven un shard por reducer
+        partitions: List[Dict[str,int]] = [{} for _ in range(R)]
+        try:
+            for fut in asyncio.as_completed(map_tasks):
+                # en un hilo: con millones de palabras el loop sigue atendiendo heartbeats y /status
+                await asyncio.to_thread(merge_shards, partitions, map_shards(await fut))
+        finally:
+            await cancel_pending(map_tasks)
+
+        # REDUCE (distribuido)
+        reducers = choose_n_workers(R)
+        red_tasks = [guarded(sem, worker_reduce(client, reducers[i], job_id, [partitions[i]])) for i in range(R)]
+        reduced_shards = await asyncio.gather(*red_tasks)
+
+        # los shards reducidos tienen palabras disjuntas: basta update (en C), sin sumar
+        final_counts: Dict[str,int] = {}
+        for d in reduced_shards:
+            final_counts.update(d)
         elapsed_ms = int((time.perf_counter() - start) * 1000)
-        st = JobStatus(job_id=job_id, status="done", result=final_counts, elapsed_ms=elapsed_ms, map_attempts=attempts, reducers=[w.url for w in reducers])
-        JOBS[job_id] = st; save_job(st); return st
+        n = st.total_splits
+        st = JobStatus.model_construct(job_id=job_id, status="done", result=final_counts, elapsed_ms=elapsed_ms, map_attempts=attempts, reducers=[w.url for w in reducers], total_splits=n, done_splits=n)
+        remember_job(st); persist(st); return job_response(st)
     except Exception as e:
         elapsed_ms = int((time.perf_counter() - start) * 1000)
-        st = JobStatus(job_id=job_id, status="error", message=str(e), elapsed_ms=elapsed_ms, map_attempts=attempts)
-        JOBS[job_id] = st; save_job(st); return st
+        st = JobStatus.model_construct(job_id=job_id, status="error", message=str(e), elapsed_ms=elapsed_ms, map_attempts=attempts, total_splits=st.total_splits, done_splits=PROGRESS.get(job_id))
+        remember_job(st); persist(st); return job_response(st)
+    finally:
+        PROGRESS.pop(job_id, None)
 
 @app.post("/submit_file", response_model=JobStatus)
 async def submit_file(req: SubmitFileReq):
@@ -329,55 +655,88 @@ async def submit_file(req: SubmitFileReq):
     in_path = DATA_DIR / "jobs" / job_id / "input.txt"
     if not in_path.exists():
         raise HTTPException(400, f"No hay input para job_id={job_id}. Sube el archivo a /upload_job_input primero.")
-    st = JobStatus(job_id=job_id, status="running")
-    JOBS[job_id] = st; save_job(st)
+    st = JobStatus.model_construct(job_id=job_id, status="running")
+    remember_job(st); persist(st)
     start = time.perf_counter()
     attempts = 0
+    mm: Optional[mmap.mmap] = None
     try:
-        splits = split_file_text(in_path, req.split_size)
+        if in_path.stat().st_size:  # mmap no acepta archivos vacíos
+            with in_path.open("rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # sigue válido al cerrar f
+        splits = split_file_ranges(mm, req.split_size) if mm is not None else []
         if not splits:
-            st = JobStatus(job_id=job_id, status="done", result={}, elapsed_ms=0, reducers=[])
-            JOBS[job_id] = st; save_job(st); return st
-
-        async with httpx.AsyncClient() as client:
-            # MAP (upload + map por file_path)
-            map_tasks = []
-            for sid, chunk_path in splits:
-                attempts += 1
-                for attempt in range(2):
-                    worker = choose_worker()
-                    try:
-                        remote_fp = await worker_upload(client, worker, job_id, sid, chunk_path)
-                        payload = {"job_id": job_id, "split_id": sid, "file_path": remote_fp}
-                        map_tasks.append(worker_map(client, worker, payload)); break
-                    except Exception:
-                        if attempt == 1: raise
-            map_partials = await asyncio.gather(*map_tasks)
-
-            # SHUFFLE/PARTITION
-            R = max(1, req.num_reducers)
-            partitions = partition_by_key(map_partials, R)
-
-            # REDUCE (distribuido)
-            reducers = choose_n_workers(R)
-            red_tasks = [worker_reduce(client, reducers[i], job_id, [partitions[i]]) for i in range(R)]
-            reduced_shards = await asyncio.gather(*red_tasks)
-
-        final_counts = local_reduce(reduced_shards)
+            st = JobStatus.model_construct(job_id=job_id, status="done", result={}, elapsed_ms=0, reducers=[])
+            remember_job(st); persist(st); return job_response(st)
+
+        st.total_splits = len(splits); PROGRESS[job_id] = 0
+        if not any_healthy():
+            # fallback: sin workers sanos, map + reduce en el master
+            attempts = len(splits)
+            final_counts = await local_map_reduce(partial(local_map_range, in_path, lower=not req.case_sensitive), splits)
+            elapsed_ms = int((time.perf_counter() - start) * 1000)
+            st = JobStatus.model_construct(job_id=job_id, status="done", result=final_counts, elapsed_ms=elapsed_ms, map_attempts=attempts, reducers=[], total_splits=len(splits), done_splits=len(splits))
+            remember_job(st); persist(st); return job_response(st)
+
+        client: httpx.AsyncClient = app.state.client
+        # MAP (los splits van dentro del POST /map: sin archivos de split ni /upload previo), en
+        # lotes como /submit pero acotados también en bytes
+        R = max(1, req.num_reducers)
+        sem = asyncio.Semaphore(2 * healthy_slots())  # tope de requests en vuelo de este job
+        map_tasks = []
+        b = 0
+        for batch in batch_ranges(splits, map_batch_size(len(splits))):
+            attempts += len(batch)
+            payload = {"job_id": job_id, "split_id": b, "case_sensitive": req.case_sensitive, "num_reducers": R}
+            map_tasks.append(track(asyncio.create_task(guarded(sem, map_file_split(client, mm, batch, payload))), job_id, len(batch)))
+            b += len(batch)
+
+        # SHUFFLE a medida que terminan los map: los workers ya devuelven un shard por reducer
+        partitions: List[Dict[str,int]] = [{} for _ in range(R)]
+        try:
+            for fut in asyncio.as_completed(map_tasks):
+                # en un hilo: con millones de palabras el loop sigue atendiendo heartbeats y /status
+                await asyncio.to_thread(merge_shards, partitions, map_shards(await fut))
+        finally:
+            await cancel_pending(map_tasks)
+
+        # REDUCE (distribuido)
+        reducers = choose_n_workers(R)
+        red_tasks = [guarded(sem, worker_reduce(client, reducers[i], job_id, [partitions[i]])) for i in range(R)]
+        reduced_shards = await asyncio.gather(*red_tasks)
+
+        # los shards reducidos tienen palabras disjuntas: basta update (en C), sin sumar
+        final_counts: Dict[str,int] = {}
+        for d in reduced_shards:
+            final_counts.update(d)
         elapsed_ms = int((time.perf_counter() - start) * 1000)
-        st = JobStatus(job_id=job_id, status="done", result=final_counts, elapsed_ms=elapsed_ms, map_attempts=attempts, reducers=[w.url for w in reducers])
-        JOBS[job_id] = st; save_job(st); return st
+        n = st.total_splits
+        st = JobStatus.model_construct(job_id=job_id, status="done", result=final_counts, elapsed_ms=elapsed_ms, map_attempts=attempts, reducers=[w.url for w in reducers], total_splits=n, done_splits=n)
+        remember_job(st); persist(st); return job_response(st)
     except Exception as e:
         elapsed_ms = int((time.perf_counter() - start) * 1000)
-        st = JobStatus(job_id=job_id, status="error", message=str(e), elapsed_ms=elapsed_ms, map_attempts=attempts)
-        JOBS[job_id] = st; save_job(st); return st
+        st = JobStatus.model_construct(job_id=job_id, status="error", message=str(e), elapsed_ms=elapsed_ms, map_attempts=attempts, total_splits=st.total_splits, done_splits=PROGRESS.get(job_id))
+        remember_job(st); persist(st); return job_response(st)
+    finally:
+        PROGRESS.pop(job_id, None)
+        if mm is not None:
+            mm.close()
 
 @app.get("/status/{job_id}", response_model=JobStatus)
-def status(job_id: str):
+async def status(job_id: str):
+    # async: JOBS solo se toca en el event loop (remember_job lo recorre y borra); al threadpool
+    # va únicamente la lectura de SQLite
     st = JOBS.get(job_id)
     if st:
-        return st
-    loaded = load_job(job_id)
+        JOBS.move_to_end(job_id)
+        if job_id in PROGRESS:
+            # el progreso se guarda aparte; la copia con done_splits solo se arma al consultar
+            return job_response(st.model_copy(update={"done_splits": PROGRESS[job_id]}))
+        return job_response(st)
+    loaded = await run_in_threadpool(load_job, job_id)
+    if job_id in JOBS:  # llegó un estado más nuevo (p. ej. un /submit) mientras se leía SQLite
+        return await status(job_id)
     if not loaded:
         raise HTTPException(404, "job no encontrado")
-    return loaded
\ No newline at end of file
+    remember_job(loaded)
+    return job_response(loaded)
\ No newline at end of file
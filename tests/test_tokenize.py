@@ -0,0 +1,50 @@
+import importlib.util, os, random, re, sys, tempfile, unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("MASTER_DATA_DIR", os.path.join(_tmp, "master"))
+os.environ.setdefault("WORKER_DATA_DIR", os.path.join(_tmp, "worker"))
+
+def load(name: str, path: Path):
+    # master/main.py y worker/main.py se llaman igual: se cargan por ruta con nombres distintos
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+worker = load("gridmr_worker", ROOT / "worker" / "main.py")
+master = load("gridmr_master", ROOT / "master" / "main.py")
+
+_word_re = re.compile(r"[\w']+")
+
+def reference(text: str, lower: bool = True):
+    # tokenizador original: findall y lower() por palabra
+    return [w.lower() for w in _word_re.findall(text)] if lower else _word_re.findall(text)
+
+# letras con casos especiales de lower() (İ, Σ final), acentos, CJK, dígitos y separadores
+ALPHABET = list("abcXYZ_'09 .,;:!?\n\t-") + list("áÉñÜßİıΣσςΟΔΑ日本語Ωкд") + ["̇", " "]
+
+class TokenizeEquivalence(unittest.TestCase):
+    def check(self, text: str):
+        for lower in (True, False):
+            exp = reference(text, lower)
+            for mod in (worker, master):
+                self.assertEqual(mod.tokenize(text, lower), exp, (mod.__name__, text, lower))
+
+    def test_fuzz(self):
+        rnd = random.Random(0)
+        for _ in range(20000):
+            self.check("".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, 24))))
+
+    def test_final_sigma(self):
+        self.check("ΟΔΟΣ.Α")
+        self.check("ΟΔΟΣ Α ΟΔΟΣ")
+        self.assertEqual(worker.tokenize("ΟΔΟΣ.Α"), ["οδος", "α"])
+
+    def test_dotted_i(self):
+        self.check("İstanbul İİ")
+
+if __name__ == "__main__":
+    unittest.main()